@@ -0,0 +1,227 @@
+import os, sys, json, time, hashlib, argparse, statistics, subprocess
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+import torch
+import torch.nn as nn
+from transformers import T5ForConditionalGeneration, T5Config
+
+from load_data import T5Dataset, normal_collate_fn, test_collate_fn
+from utils import DB_PATH, set_random_seeds, compute_records, compute_metrics, save_queries_and_records
+
+PAD_IDX = 0
+IMPORT_MODULES = ["utils", "load_data", "train_t5"]
+STAGES = ["import_utils", "dataset", "collate", "train_step", "eval_step", "generate", "compute_records", "compute_metrics"]
+
+
+def get_args():
+    '''
+    Arguments for the benchmark. Everything runs on CPU with the mini splits and a
+    tiny randomly initialized T5 so that results are comparable across runs.
+    '''
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of the text-to-SQL pipeline')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help="How many times each stage is timed; the median is reported")
+    parser.add_argument('--warmup', type=int, default=1,
+                        help="Untimed runs of each stage before measuring")
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_new_tokens', type=int, default=64,
+                        help="Generation length for the generate stage")
+    parser.add_argument('--output', type=str, default='benchmarks/latest.json',
+                        help="Where to write the JSON results")
+    parser.add_argument('--baseline', type=str, default='benchmarks/baseline.json',
+                        help="Stored baseline to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="A stage regresses when its median exceeds tolerance * baseline median")
+    parser.add_argument('--update_baseline', action='store_true',
+                        help="Overwrite the baseline with the results of this run")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    return args
+
+
+def tiny_t5():
+    '''
+    A small randomly initialized T5 that keeps the t5-small vocabulary.
+    '''
+    config = T5Config(d_model=64, d_kv=16, d_ff=128, num_layers=2, num_decoder_layers=2, num_heads=4,
+                      decoder_start_token_id=PAD_IDX)
+    return T5ForConditionalGeneration(config)
+
+
+def time_stage(fn, repeats, warmup):
+    '''
+    Run fn warmup + repeats times and return the wall times of the timed runs.
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def db_fingerprint(db_path):
+    '''
+    MD5 of the database file, so runs measured on different database contents are never compared.
+    '''
+    digest = hashlib.md5()
+    with open(db_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def import_time_us(module):
+    '''
+    Cumulative import time in microseconds of a module in a fresh interpreter,
+    as reported by python -X importtime.
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True, check=True)
+    for line in proc.stderr.splitlines():
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    return None
+
+
+def run_benchmark(args):
+    set_random_seeds(args.seed)
+    torch.set_num_threads(1)
+    model = tiny_t5()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss()
+
+    train_set = T5Dataset('data', 'mini_train')
+    dev_set = T5Dataset('data', 'mini_dev')
+    test_set = T5Dataset('data', 'mini_test')
+    train_batch = [train_set[i] for i in range(args.batch_size)]
+    test_batch = [test_set[i] for i in range(min(args.batch_size, len(test_set)))]
+    encoder_input, encoder_mask, decoder_input, decoder_targets, _ = normal_collate_fn(train_batch)
+    test_encoder_input, test_encoder_mask, decoder_initial_input = test_collate_fn(test_batch)
+    dev_sql = dev_set.sql
+    os.makedirs('benchmarks', exist_ok=True)
+    gt_sql_path = os.path.join('benchmarks', 'bench_gt.sql')
+    gt_record_path = os.path.join('benchmarks', 'bench_gt.pkl')
+    save_queries_and_records(dev_sql, gt_sql_path, gt_record_path)
+
+    def import_utils_stage():
+        # Startup of the metrics / evaluate.py path, which must not pull in torch
+        subprocess.run([sys.executable, '-c', 'import utils'], check=True)
+
+    def dataset_stage():
+        T5Dataset('data', 'mini_dev')
+
+    def collate_stage():
+        normal_collate_fn(train_batch)
+
+    def train_step_stage():
+        model.train()
+        optimizer.zero_grad()
+        logits = model(input_ids=encoder_input, attention_mask=encoder_mask,
+                       decoder_input_ids=decoder_input)['logits']
+        non_pad = decoder_targets != PAD_IDX
+        loss = criterion(logits[non_pad], decoder_targets[non_pad])
+        loss.backward()
+        optimizer.step()
+
+    def eval_step_stage():
+        model.eval()
+        with torch.no_grad():
+            logits = model(input_ids=encoder_input, attention_mask=encoder_mask,
+                           decoder_input_ids=decoder_input)['logits']
+        train_set.tokenizer.batch_decode(logits.argmax(-1), skip_special_tokens=True)
+
+    def generate_stage():
+        model.eval()
+        with torch.no_grad():
+            outputs = model.generate(input_ids=test_encoder_input, attention_mask=test_encoder_mask,
+                                     decoder_start_token_id=PAD_IDX, max_new_tokens=args.max_new_tokens,
+                                     min_new_tokens=args.max_new_tokens, num_beams=3)
+        test_set.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def compute_records_stage():
+        # Always the original database, so timings do not depend on whether optimize_db.py was run
+        compute_records(dev_sql, db_path=DB_PATH)
+
+    def compute_metrics_stage():
+        compute_metrics(gt_sql_path, gt_sql_path, gt_record_path, gt_record_path)
+
+    stage_fns = {
+        "import_utils": import_utils_stage,
+        "dataset": dataset_stage,
+        "collate": collate_stage,
+        "train_step": train_step_stage,
+        "eval_step": eval_step_stage,
+        "generate": generate_stage,
+        "compute_records": compute_records_stage,
+        "compute_metrics": compute_metrics_stage,
+    }
+    results = {}
+    for stage in STAGES:
+        times = time_stage(stage_fns[stage], args.repeats, args.warmup)
+        results[stage] = {
+            "median_s": statistics.median(times),
+            "min_s": min(times),
+            "max_s": max(times),
+            "repeats": len(times),
+        }
+        print(f"{stage:>16}: median {results[stage]['median_s']*1000:.2f} ms over {len(times)} runs")
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    '''
+    Return the stages whose median is slower than tolerance times the baseline median.
+    '''
+    regressions = []
+    for stage, stats in results.items():
+        if stage not in baseline:
+            continue
+        base = baseline[stage]["median_s"]
+        if stats["median_s"] > tolerance * base:
+            regressions.append((stage, base, stats["median_s"]))
+    return regressions
+
+
+def main():
+    args = get_args()
+    results = run_benchmark(args)
+    report = {
+        "torch": torch.__version__,
+        "python": sys.version.split()[0],
+        "repeats": args.repeats,
+        "db_path": DB_PATH,
+        "db_md5": db_fingerprint(DB_PATH),
+        "import_us": {module: import_time_us(module) for module in IMPORT_MODULES},
+        "stages": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update_baseline to create one")
+        return
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get("db_md5") != report["db_md5"]:
+        sys.exit(f"Baseline {args.baseline} was measured on a different {DB_PATH} (md5 {baseline.get('db_md5')}, "
+                 f"now {report['db_md5']}); rerun with --update_baseline to compare against this database")
+    regressions = find_regressions(results, baseline["stages"], args.tolerance)
+    for stage, base, new in regressions:
+        print(f"REGRESSION {stage}: {base*1000:.2f} ms -> {new*1000:.2f} ms")
+    if regressions:
+        sys.exit(1)
+    print(f"No stage regressed past {args.tolerance}x the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+'''
+Check that training on packed batches (load_data.PackedT5Dataset and packed_collate_fn) is
+equivalent to training on the examples one by one. On a tiny randomly initialized T5 on CPU,
+the logits of every example of a packed window must match the logits of that example run
+alone, and the token-weighted loss of a packed batch must match the unpacked one.
+
+    python check_packing.py
+'''
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+from transformers import T5Config, T5ForConditionalGeneration
+
+from load_data import PackedT5Dataset, packed_collate_fn, PAD_IDX
+from train_t5 import forward
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check that packed T5 batches match unpacked ones')
+    parser.add_argument('--num_examples', type=int, default=24)
+    parser.add_argument('--max_len', type=int, default=20, help="Maximum encoder/decoder length of an example")
+    parser.add_argument('--pack_encoder_len', type=int, default=48)
+    parser.add_argument('--pack_decoder_len', type=int, default=48)
+    parser.add_argument('--batch_size', type=int, default=3, help="Number of packed windows per batch")
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+class RandomT5Dataset(Dataset):
+    '''
+    Random token sequences with the same items as T5Dataset on a training split: (nl, query)
+    tokenizer outputs, where the query starts with the token the decoder is primed with.
+    '''
+
+    def __init__(self, num_examples, vocab_size, max_len, seed):
+        generator = torch.Generator().manual_seed(seed)
+        self.nl = []
+        self.queries = []
+        for _ in range(num_examples):
+            enc_len, dec_len = torch.randint(2, max_len + 1, (2,), generator=generator).tolist()
+            self.nl.append({'input_ids': torch.randint(1, vocab_size, (1, enc_len), generator=generator)})
+            self.queries.append({'input_ids': torch.randint(1, vocab_size, (1, dec_len), generator=generator)})
+        self.tokenizer = None
+        self.sql = []
+        self.split = 'train'
+
+    def __len__(self):
+        return len(self.nl)
+
+    def __getitem__(self, idx):
+        return self.nl[idx], self.queries[idx]
+
+
+def tiny_t5(seed):
+    torch.manual_seed(seed)
+    config = T5Config(vocab_size=64, d_model=32, d_kv=8, d_ff=64, num_layers=2, num_decoder_layers=2,
+                      num_heads=4, relative_attention_num_buckets=8, relative_attention_max_distance=16,
+                      decoder_start_token_id=PAD_IDX, pad_token_id=PAD_IDX)
+    return T5ForConditionalGeneration(config).eval()
+
+
+def main():
+    args = get_args()
+    model = tiny_t5(args.seed)
+    dataset = RandomT5Dataset(args.num_examples, model.config.vocab_size, args.max_len, args.seed)
+    packed = PackedT5Dataset(dataset, args.pack_encoder_len, args.pack_decoder_len)
+    criterion = nn.CrossEntropyLoss()
+
+    max_diff = 0.0
+    num_checked = 0
+    with torch.no_grad():
+        for start in range(0, len(packed), args.batch_size):
+            window_ids = list(range(start, min(start + args.batch_size, len(packed))))
+            encoder_input, encoder_mask, decoder_input, decoder_targets, _, masks = packed_collate_fn(
+                [packed[w] for w in window_ids])
+            logits = forward(model, encoder_input, encoder_mask, decoder_input, **masks)
+            non_pad = decoder_targets != PAD_IDX
+            packed_loss = criterion(logits[non_pad], decoder_targets[non_pad])
+
+            alone_logits = []
+            alone_targets = []
+            for b, w in enumerate(window_ids):
+                offset = 0
+                for idx in packed.windows[w]:
+                    nl, query = dataset[idx]
+                    ids = nl['input_ids']
+                    example_logits = forward(model, ids, torch.ones_like(ids), query['input_ids'][:, :-1])[0]
+                    length = example_logits.shape[0]
+                    diff = (logits[b, offset:offset + length] - example_logits).abs().max().item()
+                    if diff > args.atol:
+                        raise AssertionError(f"Example {idx} in window {w}: packed logits differ by {diff:.2e}")
+                    max_diff = max(max_diff, diff)
+                    alone_logits.append(example_logits)
+                    alone_targets.append(query['input_ids'][0, 1:])
+                    offset += length
+                    num_checked += 1
+
+            alone_loss = criterion(torch.cat(alone_logits), torch.cat(alone_targets))
+            if abs(packed_loss.item() - alone_loss.item()) > args.atol:
+                raise AssertionError(f"Batch at window {start}: packed loss {packed_loss.item():.6f} "
+                                     f"!= unpacked loss {alone_loss.item():.6f}")
+
+    print(f"Packed logits match {num_checked} examples run alone in {len(packed)} windows "
+          f"(max abs difference {max_diff:.2e}); token-weighted losses match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import os, hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
+
+from load_data import normal_collate_fn
+
+DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+CACHE_DIR = os.path.join('cache', 'encoder')
+
+
+def freeze_encoder(model):
+    '''
+    Freeze the T5 encoder so its outputs can be cached. The shared token embedding is
+    frozen as well since it is the encoder's input embedding; as T5 ties it to the
+    decoder input embedding and the LM head, only the decoder blocks keep training.
+    '''
+    for param in model.encoder.parameters():
+        param.requires_grad = False
+    model.shared.weight.requires_grad = False
+
+
+def encoder_fingerprint(model):
+    '''
+    Cheap fingerprint of the encoder weights, so that caches built from different
+    checkpoints (or random initializations) are never mixed up.
+    '''
+    digest = hashlib.md5()
+    with torch.no_grad():
+        for name, param in model.encoder.named_parameters():
+            digest.update(f'{name}:{param.double().sum().item():.6e}'.encode())
+    return digest.hexdigest()[:12]
+
+
+def build_encoder_cache(model, dataset, batch_size=64):
+    '''
+    Run the (frozen) encoder once over every input of the dataset and store the hidden
+    states as fp16 in a memory-mapped .npy file, concatenated along the token axis.
+    The cache is reused on later runs with the same inputs and encoder weights.
+
+    Returns:
+        * hidden_states (np.memmap): (total_tokens, d_model) fp16 hidden states
+        * offsets (np.ndarray): Example i spans hidden_states[offsets[i]:offsets[i + 1]]
+    '''
+    input_ids = [nl['input_ids'][0] for nl in dataset.nl]
+    digest = hashlib.md5(encoder_fingerprint(model).encode())
+    for ids in input_ids:
+        digest.update(ids.numpy().tobytes())
+    prefix = os.path.join(CACHE_DIR, f'{dataset.split}_{digest.hexdigest()[:12]}')
+    states_path, offsets_path = prefix + '_states.npy', prefix + '_offsets.npy'
+    if os.path.exists(states_path) and os.path.exists(offsets_path):
+        return np.load(states_path, mmap_mode='r'), np.load(offsets_path)
+
+    lengths = np.array([len(ids) for ids in input_ids])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = prefix + '_states.tmp.npy'
+    states = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                       shape=(int(offsets[-1]), model.config.d_model))
+    was_training = model.training
+    model.eval()
+    model.to(DEVICE)
+    with torch.no_grad():
+        for start in range(0, len(input_ids), batch_size):
+            batch_ids = input_ids[start:start + batch_size]
+            encoder_ids = pad_sequence(batch_ids, batch_first=True, padding_value=0).to(DEVICE)
+            encoder_mask = pad_sequence([torch.ones_like(ids) for ids in batch_ids], batch_first=True).to(DEVICE)
+            hidden = model.encoder(input_ids=encoder_ids, attention_mask=encoder_mask).last_hidden_state
+            hidden = hidden.to(torch.float16).cpu().numpy()
+            for j, length in enumerate(lengths[start:start + batch_size]):
+                states[offsets[start + j]:offsets[start + j + 1]] = hidden[j, :length]
+    model.train(was_training)
+    states.flush()
+    del states
+    os.replace(tmp_path, states_path)
+    np.save(offsets_path, offsets)
+    return np.load(states_path, mmap_mode='r'), offsets
+
+
+class CachedEncoderDataset(Dataset):
+    '''
+    Wraps a T5Dataset (train or dev) and adds the cached encoder hidden states of each example.
+    '''
+
+    def __init__(self, dataset, hidden_states, offsets):
+        self.dataset = dataset
+        self.hidden_states = hidden_states
+        self.offsets = offsets
+        self.tokenizer = dataset.tokenizer
+        self.sql = dataset.sql
+        self.split = dataset.split
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        nl, query = self.dataset[idx]
+        hidden = torch.from_numpy(np.array(self.hidden_states[self.offsets[idx]:self.offsets[idx + 1]]))
+        return nl, query, hidden
+
+
+def cached_collate_fn(batch):
+    '''
+    Same as normal_collate_fn, followed by a dictionary of extra model inputs holding
+    the padded BxTxD encoder hidden states.
+    '''
+    encoder_ids, encoder_mask, decoder_inputs, decoder_targets, initial_decoder_inputs = normal_collate_fn(
+        [(nl, query) for nl, query, _ in batch])
+    encoder_hidden = pad_sequence([hidden for _, _, hidden in batch], batch_first=True, padding_value=0)
+    return encoder_ids, encoder_mask, decoder_inputs, decoder_targets, initial_decoder_inputs, {'encoder_hidden': encoder_hidden}
+
+
+def get_cached_dataloader(model, dataloader, batch_size):
+    '''
+    Build the encoder cache for the dataset of a train/dev dataloader and return an
+    equivalent dataloader that also yields the cached hidden states.
+    '''
+    dataset = dataloader.dataset
+    hidden_states, offsets = build_encoder_cache(model, dataset)
+    shuffle = dataset.split == "train" or dataset.split == "mini_train"
+    return DataLoader(CachedEncoderDataset(dataset, hidden_states, offsets), batch_size=batch_size,
+                      shuffle=shuffle, collate_fn=cached_collate_fn)
@@ -0,0 +1,185 @@
+import os, sqlite3, pickle, hashlib
+from collections import deque
+
+from utils import get_db_path
+
+ALIGNMENT_PATH = 'data/alignment.txt'
+CACHE_DIR = 'cache'
+ENTITY_MODES = ["none", "annotate", "rewrite"]
+CACHE_VERSION = 2  # bump when the processing changes so cached lines are rebuilt
+
+
+class EntityMatcher:
+    '''
+    Aho-Corasick automaton over word tokens. Every phrase is mapped to the constant
+    that should appear in the SQL query (e.g. "general mitchell international" -> "mke"),
+    and a sentence is scanned for the leftmost-longest non-overlapping phrases in a
+    single pass over its words.
+
+    Inputs:
+        * phrases (dict): Lower-cased phrase -> replacement constant
+    '''
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]      # (phrase length in words, replacement) of the phrase ending at this node
+        self.out_link = [0]    # nearest proper suffix node that ends a phrase
+        for phrase, replacement in phrases.items():
+            self._add(phrase.split(), replacement)
+        self._build_links()
+
+    def _add(self, words, replacement):
+        node = 0
+        for word in words:
+            if word not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+                self.out_link.append(0)
+                self.goto[node][word] = len(self.goto) - 1
+            node = self.goto[node][word]
+        self.out[node] = (len(words), replacement)
+
+    def _build_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                queue.append(child)
+                if node == 0:
+                    continue
+                fail = self.fail[node]
+                while fail and word not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(word, 0)
+                fail_node = self.fail[child]
+                self.out_link[child] = fail_node if self.out[fail_node] is not None else self.out_link[fail_node]
+
+    def find(self, words):
+        '''
+        Return the leftmost-longest non-overlapping matches in words as (start, end, replacement).
+        '''
+        best = {}  # start -> (end, replacement) of the longest phrase starting there
+        node = 0
+        for i, word in enumerate(words):
+            while node and word not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(word, 0)
+            match = node if self.out[node] is not None else self.out_link[node]
+            while match:
+                length, replacement = self.out[match]
+                start = i - length + 1
+                if start not in best or best[start][0] < i + 1:
+                    best[start] = (i + 1, replacement)
+                match = self.out_link[match]
+
+        matches = []
+        pos = 0
+        for start in sorted(best):
+            if start >= pos:
+                end, replacement = best[start]
+                matches.append((start, end, replacement))
+                pos = end
+        return matches
+
+    def process(self, sentence, mode="annotate"):
+        '''
+        Annotate ("boston" -> "boston (BOSTON)") or rewrite ("la guardia" -> "lga")
+        every entity found in the sentence.
+        '''
+        if mode == "none":
+            return sentence
+        words = sentence.split()
+        pieces = []
+        pos = 0
+        for start, end, replacement in self.find([w.lower() for w in words]):
+            pieces.extend(words[pos:start])
+            phrase = ' '.join(words[start:end])
+            pieces.append(replacement if mode == "rewrite" else f'{phrase} ({replacement})')
+            pos = end
+        pieces.extend(words[pos:])
+        return ' '.join(pieces)
+
+
+def load_alignment(alignment_path=ALIGNMENT_PATH):
+    '''
+    Read the tab separated phrase -> constant pairs of alignment.txt. The constants are
+    upper-cased to match how they appear in the SQL queries (e.g. 'MKE', 'LOS ANGELES').
+    '''
+    phrases = {}
+    with open(alignment_path, 'r') as f:
+        for line in f:
+            if '\t' in line:
+                phrase, replacement = line.rstrip('\n').split('\t', 1)
+                phrases[phrase.strip().lower()] = replacement.strip().upper()
+    return phrases
+
+
+def load_db_entities(db_path=None):
+    '''
+    City names (mapped to their spelling in the database) and airport names (mapped
+    to their airport code) from the flight database. Returns an empty dictionary
+    if the database is not available.
+    '''
+    db_path = get_db_path() if db_path is None else db_path
+    if not os.path.exists(db_path):
+        return {}
+    conn = sqlite3.connect(db_path)
+    phrases = {}
+    for (city_name,) in conn.execute('SELECT DISTINCT city_name FROM city'):
+        if city_name:
+            phrases[city_name.lower()] = city_name
+    for airport_name, airport_code in conn.execute('SELECT DISTINCT airport_name, airport_code FROM airport'):
+        if airport_name and airport_code:
+            phrases[airport_name.lower()] = airport_code
+    conn.close()
+    return phrases
+
+
+def build_matcher(alignment_path=ALIGNMENT_PATH, db_path=None):
+    '''
+    Matcher over the database entities and the alignment phrases. Alignment entries
+    win when both define the same phrase.
+    '''
+    phrases = load_db_entities(db_path)
+    phrases.update(load_alignment(alignment_path))
+    return EntityMatcher(phrases)
+
+
+def _source_fingerprint(alignment_path, db_path):
+    digest = hashlib.md5(f'v{CACHE_VERSION}'.encode())
+    for path in (alignment_path, db_path):
+        if os.path.exists(path):
+            digest.update(f'{path}:{os.path.getmtime(path)}:{os.path.getsize(path)}'.encode())
+    return digest.hexdigest()
+
+
+def preprocess_lines(lines, split, mode, alignment_path=ALIGNMENT_PATH, db_path=None):
+    '''
+    Annotate or rewrite the entities of every line of a split, caching the result in
+    cache/<split>_<mode>.pkl. The cache is invalidated when the lines, alignment.txt
+    or the database change.
+
+    Inputs:
+        * lines (List[str]): The natural language inputs of the split
+        * split (str): Name of the split, used for the cache file
+        * mode (str): One of ENTITY_MODES
+    '''
+    if mode == "none":
+        return lines
+    db_path = get_db_path() if db_path is None else db_path
+    key = hashlib.md5('\n'.join(lines).encode()).hexdigest() + _source_fingerprint(alignment_path, db_path)
+    cache_path = os.path.join(CACHE_DIR, f'{split}_{mode}.pkl')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached_key, cached_lines = pickle.load(f)
+        if cached_key == key:
+            return cached_lines
+
+    matcher = build_matcher(alignment_path, db_path)
+    processed = [matcher.process(line, mode) for line in lines]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, 'wb') as f:
+        pickle.dump((key, processed), f)
+    return processed
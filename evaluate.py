@@ -1,18 +1,110 @@
 from argparse import ArgumentParser
-from utils import compute_metrics
+import os, glob
+from concurrent.futures import ProcessPoolExecutor
+from utils import (compute_metrics, query_log_path, format_slow_queries, load_queries_and_records,
+                   compute_sql_exact_match, compute_record_exact_match, compute_record_F1s)
 
 parser = ArgumentParser()
 parser.add_argument("-ps", "--predicted_sql", dest = "pred_sql",
-    required = True, help = "path to your model's predicted SQL queries")
+    help = "path to your model's predicted SQL queries")
 parser.add_argument("-pr", "--predicted_records", dest = "pred_records",
-    required = True, help = "path to the predicted development database records")
+    help = "path to the predicted development database records")
 parser.add_argument("-ds", "--development_sql", dest = "dev_sql",
     required = True, help = "path to the ground-truth development SQL queries")
 parser.add_argument("-dr", "--development_records", dest = "dev_records",
     required = True, help = "path to the ground-truth development database records")
+parser.add_argument("--slow_queries", dest = "slow_queries", type = int, default = 0,
+    help = "print the N slowest predicted queries and their plans, if a query log was saved")
+parser.add_argument("-pg", "--predicted_glob", dest = "pred_glob",
+    help = "batch mode: glob of predicted .sql files (e.g. 'results/*_dev.sql'); records are read from "
+           "records/<name>.pkl, or computed if missing")
+parser.add_argument("--workers", dest = "workers", type = int, default = os.cpu_count(),
+    help = "number of processes used to score experiments in batch mode")
+parser.add_argument("--compare", dest = "compare", nargs = 2, metavar = ("RUN_A", "RUN_B"),
+    help = "batch mode: print per-query record F1 wins and losses of RUN_A against RUN_B")
 
-args = parser.parse_args()
-sql_em, record_em, record_f1, _ = compute_metrics(args.dev_sql, args.pred_sql, args.dev_records, args.pred_records)
-print("SQL EM: ", sql_em)
-print("Record EM: ", record_em)
-print("Record F1: ", record_f1)
+_gt_qs = None
+_gt_records = None
+
+def _init_worker(gt_qs, gt_records):
+    # Ground truth is sent once per worker process instead of once per experiment
+    global _gt_qs, _gt_records
+    _gt_qs, _gt_records = gt_qs, gt_records
+
+def score_experiment(name, sql_path, record_path):
+    '''
+    Score one experiment against the ground truth loaded by _init_worker.
+    '''
+    model_qs, model_records, error_msgs = load_queries_and_records(sql_path, record_path)
+    f1s = compute_record_F1s(_gt_records, model_records)
+    return {
+        'name': name,
+        'sql_em': compute_sql_exact_match(_gt_qs, model_qs),
+        'record_em': compute_record_exact_match(_gt_records, model_records),
+        'record_f1': sum(f1s) / len(f1s),
+        'error_rate': sum(1 for error in error_msgs if error) / len(error_msgs),
+        'f1s': f1s,
+    }
+
+def find_experiments(pred_glob):
+    '''
+    Pair every results/<name>.sql matching the glob with records/<name>.pkl (None if missing).
+    '''
+    experiments = []
+    for sql_path in sorted(glob.glob(pred_glob)):
+        name = os.path.splitext(os.path.basename(sql_path))[0]
+        record_path = os.path.join('records', f'{name}.pkl')
+        experiments.append((name, sql_path, record_path if os.path.exists(record_path) else None))
+    return experiments
+
+def print_comparison(results, run_a, run_b, gt_qs):
+    by_name = {r['name']: r for r in results}
+    for run in (run_a, run_b):
+        if run not in by_name:
+            raise ValueError(f"Unknown run {run}; available runs: {', '.join(sorted(by_name))}")
+    f1s_a, f1s_b = by_name[run_a]['f1s'], by_name[run_b]['f1s']
+    wins = [i for i, (a, b) in enumerate(zip(f1s_a, f1s_b)) if a > b]
+    losses = [i for i, (a, b) in enumerate(zip(f1s_a, f1s_b)) if a < b]
+    print(f"\n{run_a} vs {run_b}: {len(wins)} wins, {len(losses)} losses, "
+          f"{len(f1s_a) - len(wins) - len(losses)} ties")
+    for label, indices in (("Wins", wins), ("Losses", losses)):
+        print(f"{label}:")
+        for i in indices:
+            print(f"  [{i}] F1 {f1s_a[i]:.3f} vs {f1s_b[i]:.3f}: {gt_qs[i]}")
+
+def run_batch(args):
+    gt_qs, gt_records, _ = load_queries_and_records(args.dev_sql, args.dev_records)
+    experiments = find_experiments(args.pred_glob)
+    if not experiments:
+        raise FileNotFoundError(f"No predictions match {args.pred_glob}")
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(experiments)), initializer=_init_worker,
+                             initargs=(gt_qs, gt_records)) as pool:
+        futures = [pool.submit(score_experiment, *experiment) for experiment in experiments]
+        results = [future.result() for future in futures]
+
+    results.sort(key=lambda r: (r['record_f1'], r['record_em'], r['sql_em']), reverse=True)
+    width = max(len(r['name']) for r in results)
+    print(f"{'Experiment':<{width}}  {'Record F1':>9}  {'Record EM':>9}  {'SQL EM':>7}  {'Errors':>7}")
+    for r in results:
+        print(f"{r['name']:<{width}}  {r['record_f1']:>9.4f}  {r['record_em']:>9.4f}  "
+              f"{r['sql_em']:>7.4f}  {r['error_rate']*100:>6.2f}%")
+    if args.compare:
+        print_comparison(results, *args.compare, gt_qs)
+
+def main():
+    args = parser.parse_args()
+    if args.pred_glob:
+        run_batch(args)
+        return
+    if args.pred_sql is None or args.pred_records is None:
+        parser.error("--predicted_sql and --predicted_records are required unless --predicted_glob is given")
+
+    sql_em, record_em, record_f1, _ = compute_metrics(args.dev_sql, args.pred_sql, args.dev_records, args.pred_records)
+    print("SQL EM: ", sql_em)
+    print("Record EM: ", record_em)
+    print("Record F1: ", record_f1)
+    if args.slow_queries > 0 and os.path.exists(query_log_path(args.pred_records)):
+        print(format_slow_queries(query_log_path(args.pred_records), args.slow_queries))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import os, json, time, resource
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process in MB (ru_maxrss is in KB on Linux).
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageTimer:
+    '''
+    Accumulates wall time and call counts per named stage of a training or
+    evaluation loop, plus the number of tokens processed, so an epoch can be
+    broken down into dataloader / forward / backward / optimizer / decoding / SQL time.
+
+    Inputs:
+        * sync (bool): If set, synchronize CUDA before reading the clock so that
+                       GPU stages are attributed correctly (slows training down a little)
+    '''
+
+    def __init__(self, sync=False):
+        self.sync = sync and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.tokens = 0
+        self.slots = 0
+        self.min_fill = None
+        self.query_times = {}
+        self.start = time.perf_counter()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.add(name, self._now() - start)
+
+    def add(self, name, elapsed, count=1):
+        self.times[name] += elapsed
+        self.counts[name] += count
+
+    def timed_iter(self, iterable, name='dataloader'):
+        '''
+        Wrap an iterable (e.g. a DataLoader) so the time spent waiting for each item is recorded.
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add_tokens(self, num_tokens, num_slots=None):
+        '''
+        Count processed (non-pad) tokens. If num_slots, the size of the padded tensors
+        they came in, is given, the fraction of non-pad tokens per step is tracked too.
+        '''
+        self.tokens += num_tokens
+        if num_slots:
+            self.slots += num_slots
+            fill = num_tokens / num_slots
+            self.min_fill = fill if self.min_fill is None else min(self.min_fill, fill)
+
+    def add_query_stats(self, queries, query_stats):
+        '''
+        Record per-query SQL execution times (as filled in by compute_records), keyed by query text.
+        '''
+        for i, stats in query_stats.items():
+            self.query_times[queries[i]] = stats['seconds']
+
+    def summary(self, prefix='', top_k_queries=5):
+        '''
+        Summarize everything recorded since the last reset as a flat dictionary.
+        '''
+        wall = time.perf_counter() - self.start
+        summary = {f'{prefix}wall_s': wall, f'{prefix}peak_rss_mb': peak_rss_mb()}
+        for name in self.times:
+            summary[f'{prefix}{name}_s'] = self.times[name]
+            summary[f'{prefix}{name}_count'] = self.counts[name]
+        if self.tokens:
+            summary[f'{prefix}tokens'] = self.tokens
+            summary[f'{prefix}tokens_per_s'] = self.tokens / wall if wall > 0 else 0.0
+        if self.slots:
+            summary[f'{prefix}non_pad_fraction'] = self.tokens / self.slots
+            summary[f'{prefix}min_step_non_pad_fraction'] = self.min_fill
+        if torch.cuda.is_available():
+            summary[f'{prefix}peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2**20
+        slowest = sorted(self.query_times.items(), key=lambda kv: kv[1], reverse=True)[:top_k_queries]
+        if slowest:
+            summary[f'{prefix}slowest_queries'] = [{'query': q, 'seconds': t} for q, t in slowest]
+        return summary
+
+
+def format_summary(summary):
+    '''
+    Render a summary dictionary as human readable lines for stdout.
+    '''
+    lines = []
+    for key, value in summary.items():
+        if key.endswith('slowest_queries'):
+            lines.append(f'  {key}:')
+            lines.extend(f'    {q["seconds"]*1000:8.1f} ms  {q["query"][:120]}' for q in value)
+        elif isinstance(value, float):
+            lines.append(f'  {key}: {value:.4f}')
+        else:
+            lines.append(f'  {key}: {value}')
+    return '\n'.join(lines)
+
+
+def append_jsonl(path, record):
+    '''
+    Append one JSON record to a .jsonl file, creating parent directories as needed.
+    '''
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def make_profiler(trace_dir, wait=1, warmup=1, active=5):
+    '''
+    Build a torch.profiler context that records a short window of steps and
+    writes a trace viewable in TensorBoard / Perfetto. Call .step() after every batch.
+    '''
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True,
+    )
@@ -6,16 +6,15 @@ import pickle
 from torch.utils.data import Dataset, DataLoader
 from torch.nn.utils.rnn import pad_sequence
 
-import nltk
-nltk.download('punkt')
-from transformers import T5TokenizerFast
 import torch
 
+from entity_utils import preprocess_lines
+
 PAD_IDX = 0
 
 class T5Dataset(Dataset):
 
-    def __init__(self, data_folder, split):
+    def __init__(self, data_folder, split, entity_mode="none"):
         '''
         Skeleton for the class for performing data processing for the T5 model.
 
@@ -25,12 +24,17 @@ class T5Dataset(Dataset):
             * You want to provide the decoder some beginning of sentence token. Any extra-id on the
               T5Tokenizer should serve that purpose.
             * Class behavior should be different on the test set.
+
+        entity_mode ("none", "annotate" or "rewrite") controls the entity preprocessing of the
+        natural language inputs (see entity_utils.preprocess_lines).
         '''
         self.data_folder = data_folder
         self.split = split
         self.nl = []
         self.sql = []
         self.queries = []
+        self.entity_mode = entity_mode
+        from transformers import T5TokenizerFast
         self.tokenizer: T5TokenizerFast = T5TokenizerFast.from_pretrained('google-t5/t5-small')
         self.extra_id = "<extra_id_0>"
         self.extra_token = self.tokenizer.convert_tokens_to_ids(self.extra_id)
@@ -38,6 +42,7 @@ class T5Dataset(Dataset):
 
     def process_data(self, data_folder, split, tokenizer):
         lines = load_lines(os.path.join(data_folder, f"{split}.nl"))
+        lines = preprocess_lines(lines, split, self.entity_mode)
         if split != "test" and split != "mini_test":
             queries = load_lines(os.path.join(data_folder, f"{split}.sql"))
             self.sql = queries
@@ -97,19 +102,99 @@ def test_collate_fn(batch):
     initial_decoder_inputs = torch.tensor([[PAD_IDX for i in range(len(batch))]]).mT
     return encoder_ids, encoder_mask, initial_decoder_inputs
 
-def get_dataloader(batch_size, split):
+class PackedT5Dataset(Dataset):
+
+    def __init__(self, dataset, encoder_len, decoder_len):
+        '''
+        Packs the examples of a (train) T5Dataset into windows of at most encoder_len encoder
+        tokens and decoder_len decoder tokens, using first-fit on examples sorted by decreasing
+        length. An example longer than a window gets a window of its own. Each item is the list
+        of (nl, query) examples of one window; see packed_collate_fn for the attention masks.
+        '''
+        self.dataset = dataset
+        self.tokenizer = dataset.tokenizer
+        self.sql = dataset.sql
+        self.split = dataset.split
+        self.windows = []
+        self.window_lens = []
+        lens = [(dataset.nl[i]['input_ids'].shape[1], dataset.queries[i]['input_ids'].shape[1] - 1)
+                for i in range(len(dataset))]
+        for idx in sorted(range(len(dataset)), key=lambda i: lens[i], reverse=True):
+            enc_len, dec_len = lens[idx]
+            for w, (w_enc, w_dec) in enumerate(self.window_lens):
+                if w_enc + enc_len <= encoder_len and w_dec + dec_len <= decoder_len:
+                    self.windows[w].append(idx)
+                    self.window_lens[w] = (w_enc + enc_len, w_dec + dec_len)
+                    break
+            else:
+                self.windows.append([idx])
+                self.window_lens.append((enc_len, dec_len))
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, idx):
+        return [self.dataset[i] for i in self.windows[idx]]
+
+def packed_collate_fn(batch):
+    '''
+    Collation function for PackedT5Dataset. The examples of each window are concatenated and
+    every token gets the 1-based index of its example (0 for padding). Attention masks are
+    block-diagonal over these segments so examples cannot attend to each other; T5 only uses
+    relative position biases, which are unchanged by an example's offset within the window.
+
+    Returns the same five values as normal_collate_fn (with encoder_mask marking non-pad
+    tokens), followed by a dictionary of extra model inputs:
+        * encoder_self_mask: BxTxT encoder self-attention mask
+        * decoder_self_mask: BxT'xT' causal decoder self-attention mask
+        * cross_mask: BxT'xT decoder-to-encoder attention mask
+    '''
+    enc_ids, enc_segs, dec_inputs, dec_targets, dec_segs = [], [], [], [], []
+    for window in batch:
+        enc_ids.append(torch.cat([nl['input_ids'][0] for nl, _ in window]))
+        enc_segs.append(torch.cat([torch.full((nl['input_ids'].shape[1],), s + 1) for s, (nl, _) in enumerate(window)]))
+        dec_inputs.append(torch.cat([query['input_ids'][0, :-1] for _, query in window]))
+        dec_targets.append(torch.cat([query['input_ids'][0, 1:] for _, query in window]))
+        dec_segs.append(torch.cat([torch.full((query['input_ids'].shape[1] - 1,), s + 1) for s, (_, query) in enumerate(window)]))
+    encoder_ids = pad_sequence(enc_ids, batch_first=True, padding_value=PAD_IDX)
+    encoder_segs = pad_sequence(enc_segs, batch_first=True, padding_value=0)
+    decoder_inputs = pad_sequence(dec_inputs, batch_first=True, padding_value=PAD_IDX)
+    decoder_targets = pad_sequence(dec_targets, batch_first=True, padding_value=PAD_IDX)
+    decoder_segs = pad_sequence(dec_segs, batch_first=True, padding_value=0)
+
+    encoder_mask = (encoder_segs > 0).long()
+    same_enc = (encoder_segs[:, :, None] == encoder_segs[:, None, :]) & (encoder_segs[:, None, :] > 0)
+    same_dec = (decoder_segs[:, :, None] == decoder_segs[:, None, :]) & (decoder_segs[:, None, :] > 0)
+    causal = torch.tril(torch.ones(decoder_segs.shape[1], decoder_segs.shape[1], dtype=torch.bool))
+    cross = (decoder_segs[:, :, None] == encoder_segs[:, None, :]) & (encoder_segs[:, None, :] > 0)
+    masks = {
+        'encoder_self_mask': same_enc.long(),
+        'decoder_self_mask': (same_dec & causal).long(),
+        'cross_mask': cross.long(),
+    }
+    initial_decoder_inputs = [PAD_IDX for i in range(len(batch))]
+    return encoder_ids, encoder_mask, decoder_inputs, decoder_targets, initial_decoder_inputs, masks
+
+def get_dataloader(batch_size, split, entity_mode="none", pack_lens=None):
     data_folder = 'data'
-    dset = T5Dataset(data_folder, split)
+    dset = T5Dataset(data_folder, split, entity_mode)
     shuffle = split == "train" or split == "mini_train"
     collate_fn = normal_collate_fn if split != "test" and split!="mini_test" else test_collate_fn
+    if pack_lens is not None and shuffle:
+        dset = PackedT5Dataset(dset, *pack_lens)
+        collate_fn = packed_collate_fn
 
     dataloader = DataLoader(dset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn)
     return dataloader
 
-def load_t5_data(batch_size, test_batch_size, mini=False):
-    train_loader = get_dataloader(batch_size, f"{'mini_' if mini else ''}train")
-    dev_loader = get_dataloader(test_batch_size, f"{'mini_' if mini else ''}dev")
-    test_loader = get_dataloader(test_batch_size, f"{'mini_' if mini else ''}test")
+def load_t5_data(batch_size, test_batch_size, mini=False, entity_mode="none", pack_lens=None):
+    '''
+    If pack_lens = (encoder_len, decoder_len) is given, training batches are packed
+    (see PackedT5Dataset); dev and test batches never are.
+    '''
+    train_loader = get_dataloader(batch_size, f"{'mini_' if mini else ''}train", entity_mode, pack_lens)
+    dev_loader = get_dataloader(test_batch_size, f"{'mini_' if mini else ''}dev", entity_mode)
+    test_loader = get_dataloader(test_batch_size, f"{'mini_' if mini else ''}test", entity_mode)
     
     return train_loader, dev_loader, test_loader
 
@@ -120,10 +205,10 @@ def load_lines(path):
         lines = [line.strip() for line in lines]
     return lines
 
-def load_prompting_data(data_folder):
-    train_x = load_lines(os.path.join(data_folder, "train.nl"))
+def load_prompting_data(data_folder, entity_mode="none"):
+    train_x = preprocess_lines(load_lines(os.path.join(data_folder, "train.nl")), "train", entity_mode)
     train_y = load_lines(os.path.join(data_folder, "train.sql"))
-    dev_x = load_lines(os.path.join(data_folder, "dev.nl"))
+    dev_x = preprocess_lines(load_lines(os.path.join(data_folder, "dev.nl")), "dev", entity_mode)
     dev_y = load_lines(os.path.join(data_folder, "dev.sql"))
-    test_x = load_lines(os.path.join(data_folder, "test.nl"))
+    test_x = preprocess_lines(load_lines(os.path.join(data_folder, "test.nl")), "test", entity_mode)
     return train_x, train_y, dev_x, dev_y, test_x
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os, re, json, shutil, sqlite3, argparse
+from collections import Counter, defaultdict
+
+from utils import DB_PATH, INDEXED_DB_PATH, read_queries, compute_records
+
+ALIAS_RE = re.compile(r'\b(\w+) (\1_\d+)\b')
+JOIN_RE = re.compile(r'\b(\w+_\d+)\.(\w+) = (\w+_\d+)\.(\w+)\b')
+FILTER_RE = re.compile(r"\b(\w+_\d+)\.(\w+) (?:=|<|>|<=|>=|BETWEEN|LIKE|IN) (?:'|\d|\()")
+MAX_INDEX_COLUMNS = 4
+
+
+def get_args():
+    '''
+    Arguments for building the indexed copy of the flight database.
+    '''
+    parser = argparse.ArgumentParser(description='Build an indexed, analyzed copy of the flight database')
+    parser.add_argument('--db_path', type=str, default=DB_PATH,
+                        help="Path to the original flight database")
+    parser.add_argument('--out_path', type=str, default=None,
+                        help="Where to write the indexed copy of the database (default: INDEXED_DB_PATH, "
+                             "which compute_records picks up automatically)")
+    parser.add_argument('--schema_path', type=str, default='data/flight_database.schema',
+                        help="Path to the schema file whose links describe the joins")
+    parser.add_argument('--train_sql', type=str, default='data/train.sql',
+                        help="SQL queries mined for join and filter patterns")
+    parser.add_argument('--verify_sql', type=str, default='data/dev.sql',
+                        help="Queries whose records must be identical on both databases")
+    parser.add_argument('--skip_verify', action='store_true',
+                        help="Do not check the indexed copy against the original database; "
+                             "requires an --out_path other than INDEXED_DB_PATH")
+    args = parser.parse_args()
+    if args.skip_verify:
+        if args.out_path is None or os.path.abspath(args.out_path) == os.path.abspath(INDEXED_DB_PATH):
+            parser.error(f"--skip_verify needs an explicit --out_path other than {INDEXED_DB_PATH}, "
+                         "so that an unverified database is never used by compute_records")
+    elif args.out_path is None:
+        args.out_path = INDEXED_DB_PATH
+    return args
+
+
+def read_links(schema_path):
+    '''
+    Collect the (table, column) pairs used as join keys in the schema links.
+    '''
+    with open(schema_path, 'r') as f:
+        links = json.load(f)['links']
+    columns = Counter()
+    for table, targets in links.items():
+        for target, column in targets.items():
+            columns[(table, column)] += 1
+    return columns
+
+
+def mine_query_columns(queries):
+    '''
+    Count how often each (table, column) pair is used as a join key or as a
+    filter in the given queries. Aliases such as `city_2` are resolved to their
+    table through the FROM clause.
+
+    Returns:
+        * join_columns (Counter): (table, column) -> number of joins it appears in
+        * filter_columns (Counter): (table, column) -> number of literal filters on it
+    '''
+    join_columns = Counter()
+    filter_columns = Counter()
+    for query in queries:
+        aliases = {alias: table for table, alias in ALIAS_RE.findall(query)}
+        for l_alias, l_col, r_alias, r_col in JOIN_RE.findall(query):
+            if l_alias in aliases and r_alias in aliases:
+                join_columns[(aliases[l_alias], l_col)] += 1
+                join_columns[(aliases[r_alias], r_col)] += 1
+        for alias, col in FILTER_RE.findall(query):
+            if alias in aliases:
+                filter_columns[(aliases[alias], col)] += 1
+    return join_columns, filter_columns
+
+
+def plan_indexes(conn, link_columns, join_columns, filter_columns):
+    '''
+    Decide which covering indexes to build. Every join key gets an index led by
+    that key and followed by the other columns of its table that the workload
+    touches most, so lookups through the join chain can be answered from the
+    index alone.
+
+    Returns a list of (index_name, table, columns) tuples.
+    '''
+    existing = {}
+    for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+        existing[table] = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+
+    usage = defaultdict(Counter)
+    for counter in (join_columns, filter_columns):
+        for (table, col), count in counter.items():
+            usage[table][col] += count
+
+    keys = set(join_columns) | set(link_columns)
+    indexes = []
+    for table, col in sorted(keys):
+        if table not in existing or col not in existing[table]:
+            continue
+        rest = [c for c, _ in usage[table].most_common() if c != col and c in existing[table]]
+        columns = [col] + rest[:MAX_INDEX_COLUMNS - 1]
+        indexes.append((f'idx_{table}_{col}', table, columns))
+    return indexes
+
+
+def build_indexed_db(db_path, tmp_path, indexes):
+    '''
+    Copy the database to tmp_path, build the planned indexes on the copy and
+    run ANALYZE so the query planner has statistics to pick join orders from.
+    The copy is only moved to its final path by main() once it has been verified.
+    '''
+    shutil.copyfile(db_path, tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    for name, table, columns in indexes:
+        column_list = ', '.join(f'"{c}"' for c in columns)
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_list})')
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+def verify_indexed_db(queries, db_path, out_path):
+    '''
+    Run every query against both databases and return the indices whose
+    records or error messages differ. Row order is ignored since the queries
+    carry no ORDER BY and index use may change it.
+    '''
+    orig_recs, orig_errs = compute_records(queries, db_path=db_path)
+    new_recs, new_errs = compute_records(queries, db_path=out_path)
+    mismatches = []
+    for i in range(len(queries)):
+        if Counter(orig_recs[i]) != Counter(new_recs[i]) or orig_errs[i] != new_errs[i]:
+            mismatches.append(i)
+    return mismatches
+
+
+def main():
+    args = get_args()
+    link_columns = read_links(args.schema_path)
+    join_columns, filter_columns = mine_query_columns(read_queries(args.train_sql))
+
+    conn = sqlite3.connect(args.db_path)
+    indexes = plan_indexes(conn, link_columns, join_columns, filter_columns)
+    conn.close()
+
+    tmp_path = args.out_path + '.tmp'
+    build_indexed_db(args.db_path, tmp_path, indexes)
+    for name, table, columns in indexes:
+        print(f"{name}: {table}({', '.join(columns)})")
+    print(f"Built {len(indexes)} indexes in {tmp_path}")
+
+    if not args.skip_verify:
+        mismatches = verify_indexed_db(read_queries(args.verify_sql), args.db_path, tmp_path)
+        if mismatches:
+            os.remove(tmp_path)
+            raise RuntimeError(f"Indexed database disagrees with the original on {len(mismatches)} queries "
+                               f"(first: {mismatches[:10]}); removed {tmp_path}")
+        print(f"Verified identical records on all queries in {args.verify_sql}")
+    os.replace(tmp_path, args.out_path)
+    print(f"Wrote {args.out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,15 @@ from tqdm import tqdm
 import torch, hf_token
 from transformers import GemmaTokenizerFast, GemmaForCausalLM
 from transformers import GemmaTokenizer, AutoModelForCausalLM
-from transformers import BitsAndBytesConfig
+from transformers import BitsAndBytesConfig, StoppingCriteriaList
 
 from utils import set_random_seeds, compute_metrics, save_queries_and_records, compute_records
 from prompting_utils import read_schema, extract_sql_query, save_logs, get_schema
+from prompting_utils import sql_token_budget, SQLCompleteCriteria, summarize_token_usage
 from load_data import load_prompting_data
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu') # you can add mps
-MAX_NEW_TOKENS = 16000
+MAX_NEW_TOKENS = 16000 # hard cap; the per-query budget comes from sql_token_budget
 hf_token = hf_token.hf_token
 
 
@@ -31,6 +32,12 @@ def get_args():
     parser.add_argument('-q', '--quantization', action='store_true',
                         help='Use a quantized version of the model (e.g. 4bits)')
 
+    parser.add_argument('-e', '--entity_mode', type=str, default="none", choices=["none", "annotate", "rewrite"],
+                        help='Annotate or rewrite airport/city names in the questions with their SQL constants')
+
+    parser.add_argument('--budget_quantile', type=float, default=0.99,
+                        help='Quantile of the train.sql token lengths used to set the generation budget')
+
     parser.add_argument('--seed', type=int, default=42,
                         help='Random seed to help reproducibility')
     parser.add_argument('--experiment_name', type=str, default='experiment',
@@ -58,7 +65,8 @@ def create_prompt(sentence, k, schema_path, sample_sentences = [], sample_querie
     prompt = prefix+schema+example_prefix+'\n'.join(examples)+request+'"'+sentence+'". '+suffix
     return prompt
 
-def exp_kshot(tokenizer, model: GemmaForCausalLM, inputs, k, schema_path, sample_sentences, sample_queries):
+def exp_kshot(tokenizer, model: GemmaForCausalLM, inputs, k, schema_path, sample_sentences, sample_queries,
+              max_new_tokens=MAX_NEW_TOKENS):
     '''
     k-shot prompting experiments using the provided model and tokenizer. 
     This function generates SQL queries from text prompts and evaluates their accuracy.
@@ -70,22 +78,36 @@ def exp_kshot(tokenizer, model: GemmaForCausalLM, inputs, k, schema_path, sample
         * model
         * inputs (List[str]): A list of text strings
         * k (int): Number of examples in k-shot prompting
+        * max_new_tokens (int): Generation budget per query (see sql_token_budget). It is
+                                further capped so prompt and output fit in the model's context.
+
+    Also returns (tokens generated, tokens in the extracted query) for every input.
     '''
     raw_outputs = []
     extracted_queries = []
+    token_stats = []
+    max_positions = getattr(model.config, 'max_position_embeddings', None)
 
     for i, sentence in tqdm(enumerate(inputs)):
         prompt = create_prompt(sentence, k, schema_path, sample_sentences, sample_queries) # Looking at the prompt may also help
 
         input_ids = tokenizer(prompt, return_tensors="pt").to(DEVICE)
-        outputs = model.generate(**input_ids, max_new_tokens=MAX_NEW_TOKENS) # You should set MAX_NEW_TOKENS
-        response = tokenizer.decode(outputs[0])[len(prompt):] # How does the response look like? You may need to parse it
+        prompt_len = input_ids['input_ids'].shape[1]
+        budget = min(max_new_tokens, MAX_NEW_TOKENS)
+        if max_positions is not None:
+            budget = max(1, min(budget, max_positions - prompt_len))
+        stopping_criteria = StoppingCriteriaList([SQLCompleteCriteria(tokenizer, prompt_len)])
+        outputs = model.generate(**input_ids, max_new_tokens=budget, stopping_criteria=stopping_criteria)
+        # Only decode the generated tokens rather than the whole prompt
+        response = tokenizer.decode(outputs[0][prompt_len:], skip_special_tokens=True)
         raw_outputs.append(response)
 
         # Extract the SQL query
         extracted_query = extract_sql_query(response)
         extracted_queries.append(extracted_query)
-    return raw_outputs, extracted_queries
+        used = 0 if extracted_query.startswith('ERROR') else len(tokenizer(extracted_query, add_special_tokens=False)['input_ids'])
+        token_stats.append((outputs.shape[1] - prompt_len, used))
+    return raw_outputs, extracted_queries, token_stats
 
 
 def eval_outputs(eval_x, eval_y, gt_sql_pth, model_sql_path, gt_record_path, model_record_path):
@@ -95,7 +117,7 @@ def eval_outputs(eval_x, eval_y, gt_sql_pth, model_sql_path, gt_record_path, mod
     Add/modify the arguments and code as needed.
     '''
     sql_em, record_em, record_f1, model_error_msgs = compute_metrics(gt_sql_pth, model_sql_path, gt_record_path, model_record_path)
-    error_rate = len(model_error_msgs) / len(eval_x)
+    error_rate = sum(1 for error in model_error_msgs if error) / len(eval_x)
     return sql_em, record_em, record_f1, model_error_msgs, error_rate
 
 
@@ -153,10 +175,12 @@ def main():
     set_random_seeds(args.seed)
 
     data_folder = 'data'
-    train_x, train_y, dev_x, dev_y, test_x = load_prompting_data(data_folder)
+    train_x, train_y, dev_x, dev_y, test_x = load_prompting_data(data_folder, args.entity_mode)
 
     # Model and tokenizer
     tokenizer, model = initialize_model_and_tokenizer(model_name, to_quantize)
+    max_new_tokens = sql_token_budget(tokenizer, train_y, quantile=args.budget_quantile)
+    print(f"Generation budget: {max_new_tokens} new tokens per query")
 
     for eval_split in ["dev", "test"]:
         eval_x, eval_y = (dev_x, dev_y) if eval_split == "dev" else (test_x, None)
@@ -164,34 +188,39 @@ def main():
         examples = random.sample(list(zip(train_x, train_y)), k=shot)
         sample_sentences, sample_queries = zip(*examples) if shot > 0 else ([], [])
 
-        raw_outputs, extracted_queries = exp_kshot(tokenizer, model, eval_x, shot, schema_path, sample_sentences, sample_queries)
+        raw_outputs, extracted_queries, token_stats = exp_kshot(tokenizer, model, eval_x, shot, schema_path,
+                                                                sample_sentences, sample_queries, max_new_tokens)
+        token_usage = summarize_token_usage(token_stats)
+        print(f"{eval_split} token usage: {token_usage}")
 
         # You can add any post-processing if needed
         # You can compute the records with `compute_records``
 
-        gt_query_records = f"records/{eval_split}_gt_records.pkl"
-        gt_sql_path = os.path.join(f'data/{eval_split}.sql')
-        gt_record_path = os.path.join(f'records/{eval_split}_gt_records.pkl')
-        model_sql_path = os.path.join(f'results/gemma_{experiment_name}_dev.sql')
-        model_record_path = os.path.join(f'records/gemma_{experiment_name}_dev.pkl')
-        sql_em, record_em, record_f1, model_error_msgs, error_rate = eval_outputs(
-            eval_x, eval_y,
-            gt_sql_path,
-            model_sql_path,
-            gt_query_records,
-            model_record_path
-        )
-        print(f"{eval_split} set results: ")
-        print(f"Record F1: {record_f1}, Record EM: {record_em}, SQL EM: {sql_em}")
-        print(f"{eval_split} set results: {error_rate*100:.2f}% of the generated outputs led to SQL errors")
-
-        # Save results
-        # You can for instance use the `save_queries_and_records` function
-        save_queries_and_records(eval_x, extracted_queries, model_sql_path, model_record_path)
+        model_sql_path = os.path.join(f'results/gemma_{experiment_name}_{eval_split}.sql')
+        model_record_path = os.path.join(f'records/gemma_{experiment_name}_{eval_split}.pkl')
+
+        # Save results first, so that they can be scored (and are kept for the test split)
+        save_queries_and_records(extracted_queries, model_sql_path, model_record_path)
+
+        sql_em, record_em, record_f1, model_error_msgs = None, None, None, None
+        if eval_y is not None:
+            gt_sql_path = os.path.join(f'data/{eval_split}.sql')
+            gt_record_path = os.path.join(f'records/{eval_split}_gt_records.pkl')
+            sql_em, record_em, record_f1, model_error_msgs, error_rate = eval_outputs(
+                eval_x, eval_y,
+                gt_sql_path,
+                model_sql_path,
+                gt_record_path,
+                model_record_path
+            )
+            print(f"{eval_split} set results: ")
+            print(f"Record F1: {record_f1}, Record EM: {record_em}, SQL EM: {sql_em}")
+            print(f"{eval_split} set results: {error_rate*100:.2f}% of the generated outputs led to SQL errors")
 
         # Save logs, if needed
-        log_path = "" # to specify
-        save_logs(log_path, sql_em, record_em, record_f1, model_error_msgs)
+        os.makedirs('logs', exist_ok=True)
+        log_path = os.path.join('logs', f'gemma_{experiment_name}_{eval_split}.txt')
+        save_logs(log_path, sql_em, record_em, record_f1, model_error_msgs, token_usage)
 
 
 if __name__ == "__main__":
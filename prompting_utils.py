@@ -1,5 +1,10 @@
 import os, re, utils, json
 
+import torch
+from transformers import StoppingCriteria
+
+BUDGET_SLACK_TOKENS = 64
+
 
 def read_schema(schema_path):
     '''
@@ -11,12 +16,66 @@ def read_schema(schema_path):
 
 def extract_sql_query(response):
     '''
-    Extract the SQL query from the model's response
+    Extract the SQL query from the model's response: everything from the first SELECT
+    to the last ';'. Same result as matching r'SELECT(.|\n)*;', but in linear time
+    without regex backtracking.
     '''
-    result = re.search(r'SELECT(.|\n)*;', response)
-    if result is None:
+    start = response.find('SELECT')
+    end = response.rfind(';')
+    if start == -1 or end < start:
         return 'ERROR: SQL query not found'
-    return result.group(0)
+    return response[start:end + 1]
+
+def sql_token_budget(tokenizer, sql_queries, quantile=0.99, margin=1.25, slack=BUDGET_SLACK_TOKENS):
+    '''
+    Generation budget derived from the token length distribution of reference SQL
+    queries (e.g. train.sql): the given quantile of the lengths, scaled by margin, plus
+    some slack for the text the model writes around the query.
+    '''
+    lengths = sorted(len(ids) for ids in tokenizer(sql_queries, add_special_tokens=False)['input_ids'])
+    index = min(len(lengths) - 1, int(quantile * len(lengths)))
+    return int(lengths[index] * margin) + slack
+
+class SQLCompleteCriteria(StoppingCriteria):
+    '''
+    Stops generation once a sequence has produced a SQL query terminated by ';'.
+    Only the newest token is decoded at each step; the generated text is decoded in
+    full only when that token contains ';', so the check stays cheap.
+
+    Inputs:
+        * tokenizer
+        * prompt_len (int): Number of prompt tokens at the start of each sequence
+    '''
+
+    def __init__(self, tokenizer, prompt_len):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for seq in input_ids:
+            if seq.shape[0] <= self.prompt_len or ';' not in self.tokenizer.decode(seq[-1:]):
+                done.append(False)
+                continue
+            generated = self.tokenizer.decode(seq[self.prompt_len:], skip_special_tokens=True)
+            done.append('SELECT' in generated[:generated.rfind(';')])
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+def summarize_token_usage(token_stats):
+    '''
+    Summarize per-query (tokens generated, tokens in the extracted query) pairs to show decode waste.
+    '''
+    generated = sum(g for g, _ in token_stats)
+    used = sum(u for _, u in token_stats)
+    return {
+        'queries': len(token_stats),
+        'tokens_generated': generated,
+        'tokens_used': used,
+        'mean_generated': generated / max(1, len(token_stats)),
+        'mean_used': used / max(1, len(token_stats)),
+        'waste_fraction': 1 - used / generated if generated else 0.0,
+        'max_generated': max((g for g, _ in token_stats), default=0),
+    }
 
 def get_schema(schema_path):
     '''
@@ -28,10 +87,12 @@ def get_schema(schema_path):
     return str(list(ret))
     
 
-def save_logs(output_path, sql_em, record_em, record_f1, error_msgs):
+def save_logs(output_path, sql_em, record_em, record_f1, error_msgs, token_usage=None):
     '''
     Save the logs of the experiment to files.
     You can change the format as needed.
     '''
     with open(output_path, "w") as f:
-        f.write(f"SQL EM: {sql_em}\nRecord EM: {record_em}\nRecord F1: {record_f1}\nModel Error Messages: {error_msgs}\n")
\ No newline at end of file
+        f.write(f"SQL EM: {sql_em}\nRecord EM: {record_em}\nRecord F1: {record_f1}\nModel Error Messages: {error_msgs}\n")
+        if token_usage is not None:
+            f.write(f"Token usage: {json.dumps(token_usage)}\n")
\ No newline at end of file
@@ -5,13 +5,14 @@ import torch
 import transformers
 from transformers import T5ForConditionalGeneration, T5Config
 from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS
-import wandb
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
 def setup_wandb(args):
-    # Implement this if you wish to use wandb in your experiments
-    pass
+    # Log every run of the same model type to one project, named after the experiment
+    import wandb
+    model_type = 'ft' if args.finetune else 'scr'
+    wandb.init(project=f't5_{model_type}_text_to_sql', name=args.experiment_name, config=vars(args))
 
 def initialize_model(args):
     '''
@@ -7,12 +7,13 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 import torch
 import torch.nn as nn
 import numpy as np
-import wandb
 
 from t5_utils import initialize_model, initialize_optimizer_and_scheduler, save_model, load_model_from_checkpoint, setup_wandb
 from transformers import GenerationConfig
 from load_data import load_t5_data
-from utils import compute_metrics, save_queries_and_records
+from utils import compute_metrics, save_queries_and_records, StreamingQueryExecutor
+from instrumentation import StageTimer, format_summary, append_jsonl, make_profiler
+from encoder_cache import freeze_encoder, get_cached_dataloader
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 PAD_IDX = 0
@@ -25,6 +26,8 @@ def get_args():
 
     # Model hyperparameters
     parser.add_argument('--finetune', action='store_true', help="Whether to finetune T5 or not")
+    parser.add_argument('--cache_encoder', action='store_true',
+                        help="Freeze the encoder and train/evaluate the decoder on cached encoder hidden states")
     
     # Training hyperparameters
     parser.add_argument('--optimizer_type', type=str, default="AdamW", choices=["AdamW"],
@@ -50,10 +53,37 @@ def get_args():
     parser.add_argument('--batch_size', type=int, default=16)
     parser.add_argument('--test_batch_size', type=int, default=16)
     parser.add_argument('--mini', action="store_true", help="Whether to use a small subset of the data")
+    parser.add_argument('--pack', action='store_true',
+                        help="Pack several training examples into each sequence (block-diagonal attention)")
+    parser.add_argument('--pack_encoder_len', type=int, default=128,
+                        help="Encoder tokens per packed training sequence")
+    parser.add_argument('--pack_decoder_len', type=int, default=512,
+                        help="Decoder tokens per packed training sequence")
+    parser.add_argument('--entity_mode', type=str, default="none", choices=["none", "annotate", "rewrite"],
+                        help="Annotate or rewrite airport/city names in the inputs with their SQL constants")
     parser.add_argument('--load_model', action='store_true', help="Whether to load a model from a checkpoint")
     parser.add_argument('--test_only', action='store_true', help="Whether to only run the model on test data")
+    parser.add_argument('--num_beams', type=int, default=3, help="Beam size used for test inference")
+    parser.add_argument('--num_candidates', type=int, default=1,
+                        help="If > 1, keep this many beams per question and pick the best one that executes")
+    parser.add_argument('--candidate_budget_secs', type=float, default=1.0,
+                        help="Execution budget for each candidate query when reranking; a slow chosen candidate is re-run without it")
+
+    # Instrumentation
+    parser.add_argument('--stage_log', type=str, default=None,
+                        help="JSONL file for per-epoch stage timings (default: logs/<experiment_name>_stages.jsonl)")
+    parser.add_argument('--sync_timing', action='store_true',
+                        help="Synchronize CUDA around each timed stage for accurate (but slower) GPU timings")
+    parser.add_argument('--profile_epoch', type=int, default=-1,
+                        help="If >= 0, record a torch.profiler trace during this training epoch")
+    parser.add_argument('--profile_steps', type=int, default=5,
+                        help="Number of training steps captured in the profiler trace window")
 
     args = parser.parse_args()
+    if args.cache_encoder and not args.finetune:
+        parser.error("--cache_encoder requires --finetune; freezing a randomly initialized encoder is not supported")
+    if args.cache_encoder and args.pack:
+        parser.error("--pack and --cache_encoder cannot be combined")
     return args
 
 def train(args, model, train_loader, dev_loader, optimizer, scheduler):
@@ -66,16 +96,32 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler):
     gt_record_path = os.path.join(f'records/dev_gt_records.pkl')
     model_sql_path = os.path.join(f'results/t5_{model_type}_{args.experiment_name}_dev.sql')
     model_record_path = os.path.join(f'records/t5_{model_type}_{args.experiment_name}_dev.pkl')
+    stage_log = args.stage_log or os.path.join('logs', f'{args.experiment_name}_stages.jsonl')
+    train_timer = StageTimer(sync=args.sync_timing)
+    eval_timer = StageTimer(sync=args.sync_timing)
     for epoch in range(args.max_n_epochs):
-        tr_loss = train_epoch(args, model, train_loader, optimizer, scheduler)
+        train_timer.reset()
+        profiler = None
+        if epoch == args.profile_epoch:
+            profiler = make_profiler(os.path.join('profiles', args.experiment_name), active=args.profile_steps)
+            profiler.start()
+        tr_loss = train_epoch(args, model, train_loader, optimizer, scheduler, timer=train_timer, profiler=profiler)
+        if profiler is not None:
+            profiler.stop()
         print(f"Epoch {epoch}: Average train loss was {tr_loss}")
 
+        eval_timer.reset()
         eval_loss, record_f1, record_em, sql_em, error_rate = eval_epoch(args, model, dev_loader,
                                                                          gt_sql_path, model_sql_path,
-                                                                         gt_record_path, model_record_path)
+                                                                         gt_record_path, model_record_path,
+                                                                         timer=eval_timer)
         print(f"Epoch {epoch}: Dev loss: {eval_loss}, Record F1: {record_f1}, Record EM: {record_em}, SQL EM: {sql_em}")
         print(f"Epoch {epoch}: {error_rate*100:.2f}% of the generated outputs led to SQL errors")
 
+        stage_summary = {**train_timer.summary(prefix='train/'), **eval_timer.summary(prefix='dev/')}
+        print(f"Epoch {epoch}: stage timings\n{format_summary(stage_summary)}")
+        append_jsonl(stage_log, {'epoch': epoch, **stage_summary})
+
         if args.use_wandb:
             result_dict = {
                 'train/loss' : tr_loss,
@@ -85,6 +131,8 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler):
                 'dev/sql_em' : sql_em,
                 'dev/error_rate' : error_rate,
             }
+            result_dict.update({k: v for k, v in stage_summary.items() if not k.endswith('slowest_queries')})
+            import wandb
             wandb.log(result_dict, step=epoch)
 
         if record_f1 > best_f1:
@@ -100,42 +148,78 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler):
         if epochs_since_improvement >= args.patience_epochs:
             break
 
-def train_epoch(args, model, train_loader, optimizer, scheduler):
+def forward(model, encoder_input, encoder_mask, decoder_input, encoder_hidden=None,
+            encoder_self_mask=None, decoder_self_mask=None, cross_mask=None):
+    '''
+    Teacher-forced forward pass returning the logits. If cached encoder hidden states
+    are given (see encoder_cache.py), the encoder is skipped entirely. For packed batches
+    (see load_data.packed_collate_fn) the block-diagonal masks replace the padding masks;
+    the encoder is run separately because its self-attention mask and the decoder's
+    cross-attention mask have different shapes.
+    '''
+    if encoder_hidden is not None:
+        return model(
+            encoder_outputs=(encoder_hidden.to(model.dtype),),
+            attention_mask=encoder_mask,
+            decoder_input_ids=decoder_input,
+        )['logits']
+    if encoder_self_mask is not None:
+        encoder_outputs = model.encoder(input_ids=encoder_input, attention_mask=encoder_self_mask)
+        return model(
+            encoder_outputs=encoder_outputs,
+            attention_mask=cross_mask,
+            decoder_input_ids=decoder_input,
+            decoder_attention_mask=decoder_self_mask,
+        )['logits']
+    return model(
+        input_ids=encoder_input,
+        attention_mask=encoder_mask,
+        decoder_input_ids=decoder_input,
+    )['logits']
+
+def train_epoch(args, model, train_loader, optimizer, scheduler, timer=None, profiler=None):
     model.train()
     total_loss = 0
     total_tokens = 0
     criterion = nn.CrossEntropyLoss()
+    timer = timer if timer is not None else StageTimer()
 
-    for encoder_input, encoder_mask, decoder_input, decoder_targets, _ in tqdm(train_loader):
+    for batch in tqdm(timer.timed_iter(train_loader), total=len(train_loader)):
+        encoder_input, encoder_mask, decoder_input, decoder_targets = batch[:4]
         optimizer.zero_grad()
-        encoder_input = encoder_input.to(DEVICE)
-        encoder_mask = encoder_mask.to(DEVICE)
-        decoder_input = decoder_input.to(DEVICE)
-        decoder_targets = decoder_targets.to(DEVICE)
+        with timer.stage('to_device'):
+            encoder_input = encoder_input.to(DEVICE)
+            encoder_mask = encoder_mask.to(DEVICE)
+            decoder_input = decoder_input.to(DEVICE)
+            decoder_targets = decoder_targets.to(DEVICE)
+            extras = {k: v.to(DEVICE) for k, v in batch[5].items()} if len(batch) > 5 else {}
         
-        model = model.to(DEVICE)
+            model = model.to(DEVICE)
 
-        logits = model(
-            input_ids=encoder_input,
-            attention_mask=encoder_mask,
-            decoder_input_ids=decoder_input,
-        )['logits']
+        with timer.stage('forward'):
+            logits = forward(model, encoder_input, encoder_mask, decoder_input, **extras)
         
-        non_pad = decoder_targets != PAD_IDX
-        loss = criterion(logits[non_pad], decoder_targets[non_pad])
-        loss.backward()
-        optimizer.step()
-        if scheduler is not None: 
-            scheduler.step()
+            non_pad = decoder_targets != PAD_IDX
+            loss = criterion(logits[non_pad], decoder_targets[non_pad])
+        with timer.stage('backward'):
+            loss.backward()
+        with timer.stage('optimizer'):
+            optimizer.step()
+            if scheduler is not None: 
+                scheduler.step()
 
         with torch.no_grad():
             num_tokens = torch.sum(non_pad).item()
             total_loss += loss.item() * num_tokens
             total_tokens += num_tokens
+            timer.add_tokens(torch.sum(encoder_mask).item() + num_tokens,
+                             encoder_mask.numel() + decoder_targets.numel())
+        if profiler is not None:
+            profiler.step()
 
     return total_loss / total_tokens
         
-def eval_epoch(args, model, dev_loader, gt_sql_pth, model_sql_path, gt_record_path, model_record_path):
+def eval_epoch(args, model, dev_loader, gt_sql_pth, model_sql_path, gt_record_path, model_record_path, timer=None):
     '''
     You must implement the evaluation loop to be using during training. We recommend keeping track
     of the model loss on the SQL queries, the metrics compute_metrics returns (save_queries_and_records should be helpful)
@@ -151,28 +235,32 @@ def eval_epoch(args, model, dev_loader, gt_sql_pth, model_sql_path, gt_record_pa
     total_loss = 0
     total_tokens = 0
     pred_list = []
+    timer = timer if timer is not None else StageTimer()
     if args.mini:
         gt_sql_pth = gt_sql_pth.replace('dev', 'mini_dev')
         gt_record_path = gt_record_path.replace('dev', 'mini_dev')
         model_sql_path = model_sql_path.replace('dev', 'mini_dev')
         model_record_path = model_record_path.replace('dev', 'mini_dev')
     
-    for encoder_input, encoder_mask, decoder_input, decoder_targets, _ in tqdm(dev_loader):
+    for batch in tqdm(timer.timed_iter(dev_loader), total=len(dev_loader)):
+        encoder_input, encoder_mask, decoder_input, decoder_targets = batch[:4]
         
-        encoder_input = encoder_input.to(DEVICE)
-        encoder_mask = encoder_mask.to(DEVICE)
-        decoder_input = decoder_input.to(DEVICE)
-        decoder_targets = decoder_targets.to(DEVICE)
+        with timer.stage('to_device'):
+            encoder_input = encoder_input.to(DEVICE)
+            encoder_mask = encoder_mask.to(DEVICE)
+            decoder_input = decoder_input.to(DEVICE)
+            decoder_targets = decoder_targets.to(DEVICE)
+            extras = {k: v.to(DEVICE) for k, v in batch[5].items()} if len(batch) > 5 else {}
         
-        model = model.to(DEVICE)
+            model = model.to(DEVICE)
 
-        logits = model(
-            input_ids=encoder_input,
-            attention_mask=encoder_mask,
-            decoder_input_ids=decoder_input,
-        )['logits']
+        with timer.stage('forward'):
+            logits = forward(model, encoder_input, encoder_mask, decoder_input, **extras)
         
-        preds = dev_loader.dataset.tokenizer.batch_decode(logits.argmax(-1), skip_special_tokens=True)
+        with timer.stage('argmax'):
+            pred_ids = logits.argmax(-1).cpu()
+        with timer.stage('batch_decode'):
+            preds = dev_loader.dataset.tokenizer.batch_decode(pred_ids, skip_special_tokens=True)
         pred_list.extend(preds)
 
         non_pad = decoder_targets != PAD_IDX
@@ -182,20 +270,37 @@ def eval_epoch(args, model, dev_loader, gt_sql_pth, model_sql_path, gt_record_pa
             num_tokens = torch.sum(non_pad).item()
             total_loss += loss.item() * num_tokens
             total_tokens += num_tokens
+            timer.add_tokens(torch.sum(encoder_mask).item() + num_tokens)
             
     dev_loss = total_loss / total_tokens
-    save_queries_and_records(pred_list, model_sql_path, model_record_path)
-    save_queries_and_records(dev_loader.dataset.sql, gt_sql_pth, gt_record_path)
-    sql_em, record_em, record_F1, error_msgs = compute_metrics(gt_sql_pth, model_sql_path, gt_record_path, model_record_path)
+    query_stats = {}
+    with timer.stage('sql'):
+        save_queries_and_records(pred_list, model_sql_path, model_record_path, query_stats=query_stats)
+    timer.add_query_stats(pred_list, query_stats)
+    with timer.stage('gt_sql'):
+        save_queries_and_records(dev_loader.dataset.sql, gt_sql_pth, gt_record_path)
+    with timer.stage('metrics'):
+        sql_em, record_em, record_F1, error_msgs = compute_metrics(gt_sql_pth, model_sql_path, gt_record_path, model_record_path)
     return dev_loss, record_em, record_F1, sql_em, sum([1 for error in error_msgs if 'error' in error.lower()]) / len(pred_list)
         
 def test_inference(args, model, test_loader, model_sql_path, model_record_path):
     '''
     You must implement inference to compute your model's generated SQL queries and its associated 
     database records. Implementation should be very similar to eval_epoch.
+
+    Each decoded batch is handed to a StreamingQueryExecutor, so its SQL runs while the
+    next batch is generated and the .sql file and record journal are usable if interrupted.
+    With --num_candidates > 1, the executor also reranks the beams of each question by
+    execution, in the background and with one shared cache of executed candidates.
     '''
     model.eval()
-    pred_list = []
+    num_candidates = max(1, args.num_candidates)
+    num_beams = max(args.num_beams, num_candidates)
+    if args.mini:
+        model_sql_path = model_sql_path.replace('test', 'mini_test')
+        model_record_path = model_record_path.replace('test', 'mini_test')
+    query_budget_secs = args.candidate_budget_secs if num_candidates > 1 else None
+    executor = StreamingQueryExecutor(model_sql_path, model_record_path, query_budget_secs=query_budget_secs)
     
     for encoder_input, encoder_mask, decoder_initial_input in tqdm(test_loader):
         
@@ -204,14 +309,15 @@ def test_inference(args, model, test_loader, model_sql_path, model_record_path):
         decoder_initial_input = decoder_initial_input.to(DEVICE)
         
         model = model.to(DEVICE)
-        logits = model.generate(input_ids=encoder_input, attention_mask=encoder_mask,decoder_start_token_id=decoder_initial_input,max_new_tokens=500, num_beams=3, early_stopping=True)
+        logits = model.generate(input_ids=encoder_input, attention_mask=encoder_mask,decoder_start_token_id=decoder_initial_input,max_new_tokens=500, num_beams=num_beams, early_stopping=True,
+                                num_return_sequences=num_candidates)
         
         preds = test_loader.dataset.tokenizer.batch_decode(logits, batch_first=True, skip_special_tokens=True)
-        pred_list.extend(preds)
-    if args.mini:
-        model_sql_path = model_sql_path.replace('test', 'mini_test')
-        model_record_path = model_record_path.replace('test', 'mini_test')
-    save_queries_and_records(pred_list, model_sql_path, model_record_path)
+        # generate returns the num_candidates beams of each question consecutively, best first
+        executor.submit_candidates([preds[i:i + num_candidates] for i in range(0, len(preds), num_candidates)])
+    _, error_msgs = executor.close()
+    if num_candidates > 1:
+        print(f"Execution-guided reranking replaced the top beam for {executor.num_reranked}/{len(error_msgs)} questions")
 
 def main():
     # Get key arguments
@@ -224,8 +330,14 @@ def main():
     experiment_name = args.experiment_name
 
     # Load the data and the model
-    train_loader, dev_loader, test_loader = load_t5_data(args.batch_size, args.test_batch_size, mini=args.mini)
+    pack_lens = (args.pack_encoder_len, args.pack_decoder_len) if args.pack else None
+    train_loader, dev_loader, test_loader = load_t5_data(args.batch_size, args.test_batch_size, mini=args.mini,
+                                                         entity_mode=args.entity_mode, pack_lens=pack_lens)
     model = initialize_model(args) if not args.load_model else load_model_from_checkpoint(args, checkpoint_dir=checkpoint_dir, best=True)
+    if args.cache_encoder:
+        freeze_encoder(model)
+        train_loader = get_cached_dataloader(model, train_loader, args.batch_size)
+        dev_loader = get_cached_dataloader(model, dev_loader, args.test_batch_size)
     optimizer, scheduler = initialize_optimizer_and_scheduler(args, model, len(train_loader))
 
     # Train
@@ -1,17 +1,28 @@
+# Only lightweight modules are imported at load time so that the metrics and
+# evaluation CLI start without torch; numpy, torch and tqdm are imported where used.
 import sqlite3
-import numpy as np
 import os
 import re
 import pickle
 import random
-from tqdm import tqdm
+import time
+import json
+import threading
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from typing import List, Any
 
-import torch
-
 DB_PATH = 'data/flight_database.db'
+INDEXED_DB_PATH = 'data/flight_database_indexed.db'
+SLOW_QUERY_SECS = 0.5
+PROGRESS_STEPS = 1000  # SQLite VM steps between progress handler calls; resolution of vm_steps_approx
+
+def get_db_path():
+    '''
+    Use the indexed copy of the database built by optimize_db.py when it exists.
+    It is only kept on disk after its records were verified against DB_PATH.
+    '''
+    return INDEXED_DB_PATH if os.path.exists(INDEXED_DB_PATH) else DB_PATH
 
 def compute_metrics(gt_path: str, model_path: str, gt_query_records: str = None, model_query_records: str = None):
     '''
@@ -57,15 +68,23 @@ def load_queries_and_records(sql_path: str, record_path: str):
 
     return read_qs, records, error_msgs
 
-def save_queries_and_records(sql_queries: List[str], sql_path: str, record_path: str):
+def save_queries_and_records(sql_queries: List[str], sql_path: str, record_path: str, query_stats: dict = None):
     '''
     Helper function to save model generated SQL queries and their associated records
-    to the specified paths.
+    to the specified paths. Per-query execution statistics are written next to the
+    records as <record_path without .pkl>_querylog.json (see save_query_log).
 
     Inputs: 
         * sql_queries (List[str]): The list of SQL queries to save
         * sql_path (str): Path to save SQL queries
         * record_path (str): Path to save database records associated with queries
+        * query_stats (dict): If provided, filled with the execution statistics of each query index
+
+    Records are journaled to <record_path>.journal as each query finishes. If a previous call
+    with the same queries was interrupted, finished queries are read back from the journal
+    instead of being executed again. The journal is only removed once every query has finished;
+    if some timed out, the saved records report them as "Query timed out" and the journal is
+    kept, so that a rerun executes only those queries.
     '''
     # First save the queries
     with open(sql_path, 'w') as f:
@@ -73,16 +92,291 @@ def save_queries_and_records(sql_queries: List[str], sql_path: str, record_path:
             f.write(f'{query.split("</s>")[0]}\n')
 
     # Next compute and save records
-    records, error_msgs = compute_records(sql_queries)    
-    with open(record_path, 'wb') as f:
-        pickle.dump((records, error_msgs), f)
+    query_stats = {} if query_stats is None else query_stats
+    journal_path = record_path + '.journal'
+    records, error_msgs = compute_records(sql_queries, query_stats=query_stats, journal_path=journal_path)
+    atomic_pickle_dump((records, error_msgs), record_path)
+    save_query_log(sql_queries, query_stats, query_log_path(record_path))
+    remove_finished_journal(journal_path, len(sql_queries), len(query_stats))
+
+def atomic_pickle_dump(obj, path: str):
+    '''
+    Pickle obj to a temporary file and rename it over path, so that path never holds a partial pickle.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def remove_finished_journal(journal_path: str, num_queries: int, num_finished: int):
+    '''
+    Remove a record journal once all num_queries queries have a journaled result. Otherwise
+    the journal is kept next to the (partial) records so that a rerun resumes from it.
+    '''
+    if num_finished == num_queries:
+        os.remove(journal_path)
+    else:
+        print(f"{num_queries - num_finished}/{num_queries} queries did not finish; keeping {journal_path} "
+              "so that a rerun only executes those")
+
+def read_journal(journal_path: str):
+    '''
+    Read the (query_id, query, rec, error_msg, stats) entries of a record journal.
+    A partially written entry at the end (e.g. from a crash mid-write) is dropped
+    and truncated away so that new entries can be appended after the last good one.
+    '''
+    entries = []
+    if not os.path.exists(journal_path):
+        return entries
+    with open(journal_path, 'rb+') as f:
+        good_offset = 0
+        while True:
+            try:
+                entries.append(pickle.load(f))
+                good_offset = f.tell()
+            except EOFError:
+                break
+            except Exception:
+                f.truncate(good_offset)
+                break
+    return entries
+
+def query_log_path(record_path: str):
+    return os.path.splitext(record_path)[0] + '_querylog.json'
+
+def save_query_log(sql_queries: List[str], query_stats: dict, log_path: str, top_n: int = 10):
+    '''
+    Save per-query execution statistics along with the indices of the top_n slowest queries.
+
+    Inputs:
+        * sql_queries (List[str]): The executed SQL queries
+        * query_stats (dict): Query index -> statistics, as filled in by compute_records
+        * log_path (str): Path of the .json log to write
+        * top_n (int): Number of slowest queries to list in the summary
+    '''
+    queries = [{'index': i, 'query': sql_queries[i], **query_stats[i]} for i in sorted(query_stats)]
+    slowest = sorted(queries, key=lambda q: q['seconds'], reverse=True)[:top_n]
+    with open(log_path, 'w') as f:
+        json.dump({
+            'total_seconds': sum(q['seconds'] for q in queries),
+            'vm_steps_resolution': PROGRESS_STEPS,
+            'slowest': [q['index'] for q in slowest],
+            'queries': queries,
+        }, f, indent=1)
+
+def format_slow_queries(log_path: str, top_n: int = 10):
+    '''
+    Render the slowest queries of a saved query log, with their query plans when captured.
+    '''
+    with open(log_path, 'r') as f:
+        log = json.load(f)
+    by_index = {q['index']: q for q in log['queries']}
+    lines = [f"Total SQL time: {log['total_seconds']:.2f}s over {len(log['queries'])} queries"]
+    for i in log['slowest'][:top_n]:
+        q = by_index[i]
+        lines.append(f"[{i}] {q['seconds']*1000:.1f} ms, {q['rows']} rows, ~{q['vm_steps_approx']} VM steps: {q['query']}")
+        lines.extend(f"    {step}" for step in q.get('plan', []))
+    return '\n'.join(lines)
 
 def read_queries(sql_path: str):
     with open(sql_path, 'r') as f:
         qs = [q.strip() for q in f.readlines()]
     return qs
 
-def compute_records(processed_qs: List[str]):
+class StreamingQueryExecutor:
+    '''
+    Streaming counterpart of save_queries_and_records: queries are submitted to a thread
+    pool as soon as they are produced (e.g. after each decoded batch), so SQL execution
+    overlaps with generation. Finished records are appended to the same journal as
+    compute_records, which lets an interrupted run resume, and close() writes the records
+    pickle and query log once every query is done.
+
+    Questions can also be submitted with several candidate queries (n-best beams, best
+    first) for execution-guided reranking: every distinct candidate is executed once,
+    shared across beams and questions, and a question resolves to its first candidate
+    that executes without error (or its top candidate if none does). The records of the
+    chosen candidate are taken from that execution rather than running it again. Lines
+    of sql_path are written in question order as soon as questions resolve.
+
+    query_budget_secs only serves the ranking: a candidate interrupted by the budget is
+    not counted as an error, and if it is chosen it is run once more without the budget
+    so that its real records are saved.
+
+    Inputs:
+        * sql_path (str): Path to save SQL queries
+        * record_path (str): Path to save database records associated with queries
+        * num_threads (int): Number of threads executing queries
+        * timeout_secs (float): How long close() waits for outstanding queries
+        * query_budget_secs (float): If provided, per-candidate execution budget used for ranking
+    '''
+
+    def __init__(self, sql_path: str, record_path: str, num_threads: int = 10, timeout_secs: float = 120,
+                 query_budget_secs: float = None):
+        self.record_path = record_path
+        self.journal_path = record_path + '.journal'
+        self.timeout_secs = timeout_secs
+        self.query_budget_secs = query_budget_secs
+        self.db_path = get_db_path()
+        self.queries = []
+        self.rec_dict = {}
+        self.query_stats = {}
+        self.exec_futures = {}   # query text -> future of its execution, shared by all questions
+        self.dependents = {}     # query text -> ids of unresolved questions that have it as a candidate
+        self.waiting = {}        # question id -> candidates, until the question is resolved
+        self.rerun_futures = {}  # query text -> future of its execution without the budget
+        self.rerun_dependents = {}
+        self.reruns = {}         # question id -> chosen candidate being run without the budget
+        self.num_reranked = 0
+        self.next_to_write = 0
+        self.lock = threading.RLock()
+        self.closed = False
+        self.resumed = {query_id: (query, rec, error_msg, stats)
+                        for query_id, query, rec, error_msg, stats in read_journal(self.journal_path)}
+        self.sql_file = open(sql_path, 'w')
+        self.journal = open(self.journal_path, 'ab')
+        self.pool = ThreadPoolExecutor(num_threads)
+
+    def submit(self, sql_queries: List[str]):
+        '''
+        Start executing a batch of queries, one per question.
+        '''
+        self.submit_candidates([[query] for query in sql_queries])
+
+    def submit_candidates(self, candidates: List[List[str]]):
+        '''
+        Start executing a batch of questions, each given as its candidate queries sorted by score.
+        '''
+        with self.lock:
+            for cands in candidates:
+                query_id = len(self.queries)
+                self.queries.append(cands[0])
+                resumed = self.resumed.pop(query_id, None)
+                if resumed is not None and resumed[0] in cands:
+                    query, rec, error_msg, stats = resumed
+                    self.queries[query_id] = query
+                    self.rec_dict[query_id] = (rec, error_msg)
+                    self.query_stats[query_id] = stats
+                    continue
+                self.waiting[query_id] = cands
+                for query in dict.fromkeys(cands):
+                    self.dependents.setdefault(query, []).append(query_id)
+                    if query not in self.exec_futures:
+                        future = self.pool.submit(compute_record, 0, query, self.db_path, self.query_budget_secs)
+                        self.exec_futures[query] = future
+                        future.add_done_callback(lambda _, query=query: self._on_done(query))
+                self._try_resolve(query_id)
+            self._write_sql()
+
+    @staticmethod
+    def _result(futures, query):
+        future = futures.get(query)
+        if future is None or not future.done() or future.cancelled():
+            return None
+        _, rec, error_msg, stats = future.result()
+        return rec, error_msg, stats
+
+    def _on_done(self, query, rerun=False):
+        with self.lock:
+            if self.closed:
+                return
+            for query_id in (self.rerun_dependents if rerun else self.dependents).pop(query, []):
+                self._try_resolve(query_id)
+            self._write_sql()
+
+    def _try_resolve(self, query_id, final=False):
+        '''
+        Resolve a question once all its candidates have run (or, if final, with whatever has run).
+        '''
+        cands = self.waiting.get(query_id)
+        if cands is None:
+            return
+        if query_id in self.reruns:
+            query = self.reruns[query_id]
+            result = self._result(self.rerun_futures, query)
+            if result is not None or final:
+                self._resolve(query_id, cands.index(query), result)
+            return
+
+        results = [self._result(self.exec_futures, query) for query in cands]
+        if not final and any(result is None for result in results):
+            return
+        # Candidates interrupted by the budget are slow, not wrong, so they are not skipped
+        chosen = next((i for i, result in enumerate(results)
+                       if result is not None and (result[1] == "" or result[2].get('interrupted'))), 0)
+        if results[chosen] is not None and results[chosen][2].get('interrupted') and not final:
+            query = cands[chosen]
+            self.reruns[query_id] = query
+            self.rerun_dependents.setdefault(query, []).append(query_id)
+            if query not in self.rerun_futures:
+                future = self.pool.submit(compute_record, 0, query, self.db_path, None)
+                self.rerun_futures[query] = future
+                future.add_done_callback(lambda _, query=query: self._on_done(query, rerun=True))
+            self._try_resolve(query_id)
+            return
+        self._resolve(query_id, chosen, results[chosen])
+
+    def _resolve(self, query_id, chosen, result):
+        cands = self.waiting.pop(query_id)
+        self.reruns.pop(query_id, None)
+        rec, error_msg, stats = result if result is not None else ([], "Query timed out", None)
+        self.num_reranked += chosen != 0
+        self.queries[query_id] = cands[chosen]
+        self.rec_dict[query_id] = (rec, error_msg)
+        if stats is not None:
+            self.query_stats[query_id] = stats
+            pickle.dump((query_id, cands[chosen], rec, error_msg, stats), self.journal)
+            self.journal.flush()
+
+    def _write_sql(self):
+        # Lines are written in question order, up to the first unresolved question
+        while self.next_to_write < len(self.queries) and self.next_to_write in self.rec_dict:
+            self.sql_file.write(f'{self.queries[self.next_to_write].split("</s>")[0]}\n')
+            self.next_to_write += 1
+        self.sql_file.flush()
+
+    def close(self):
+        '''
+        Wait for outstanding queries, then save the records and query log like
+        save_queries_and_records. Returns the records and error messages.
+        '''
+        deadline = time.perf_counter() + self.timeout_secs
+        while True:
+            with self.lock:
+                # Resolving here also submits any reruns of chosen candidates whose callbacks have not run yet
+                for query_id in list(self.waiting):
+                    self._try_resolve(query_id)
+                pending = [future for future in list(self.exec_futures.values()) + list(self.rerun_futures.values())
+                           if not future.done()]
+            remaining = deadline - time.perf_counter()
+            if not pending or remaining <= 0:
+                break
+            wait(pending, timeout=remaining)
+        for future in pending:
+            future.cancel()
+        with self.lock:
+            for query_id in list(self.waiting):
+                self._try_resolve(query_id, final=True)
+            self._write_sql()
+            self.closed = True
+            self.journal.close()
+            self.sql_file.close()
+        self.pool.shutdown(wait=False)
+
+        recs = []
+        error_msgs = []
+        for i in range(len(self.queries)):
+            rec, error_msg = self.rec_dict[i]
+            recs.append(rec)
+            error_msgs.append(error_msg)
+        atomic_pickle_dump((recs, error_msgs), self.record_path)
+        save_query_log(self.queries, self.query_stats, query_log_path(self.record_path))
+        remove_finished_journal(self.journal_path, len(self.queries), len(self.query_stats))
+        return recs, error_msgs
+
+def compute_records(processed_qs: List[str], db_path: str = None, query_stats: dict = None, journal_path: str = None,
+                    query_budget_secs: float = None):
     '''
     Helper function for computing the records associated with each SQL query in the
     input list. You may change the number of threads or the timeout variable (in seconds)
@@ -90,24 +384,53 @@ def compute_records(processed_qs: List[str]):
 
     Input:
         * processed_qs (List[str]): The list of SQL queries to execute
+        * db_path (str): If provided, the database to run the queries on. Defaults to get_db_path()
+        * query_stats (dict): If provided, filled with the execution statistics of each query index
+                              (see compute_record)
+        * journal_path (str): If provided, each finished query is appended to this journal and
+                              queries already in it (same index and text) are not executed again.
+                              Timed out queries are not journaled, so they are retried on resume.
+        * query_budget_secs (float): If provided, queries running longer than this are interrupted
+                                     and reported as errors
     '''
+    from tqdm import tqdm
+
     num_threads = 10
     timeout_secs = 120
+    db_path = get_db_path() if db_path is None else db_path
+
+    rec_dict = {}
+    journal = None
+    if journal_path is not None:
+        for query_id, query, rec, error_msg, stats in read_journal(journal_path):
+            if query_id < len(processed_qs) and processed_qs[query_id] == query:
+                rec_dict[query_id] = (rec, error_msg)
+                if query_stats is not None:
+                    query_stats[query_id] = stats
+        journal = open(journal_path, 'ab')
 
     pool = ThreadPoolExecutor(num_threads)
     futures = []
     for i, query in enumerate(processed_qs):
-        futures.append(pool.submit(compute_record, i, query))
+        if i not in rec_dict:
+            futures.append(pool.submit(compute_record, i, query, db_path, query_budget_secs))
         
-    rec_dict = {}
     try:
-        for x in tqdm(as_completed(futures, timeout=timeout_secs)):
-            query_id, rec, error_msg = x.result()
+        for x in tqdm(as_completed(futures, timeout=timeout_secs), total=len(futures)):
+            query_id, rec, error_msg, stats = x.result()
             rec_dict[query_id] = (rec, error_msg)
+            if query_stats is not None:
+                query_stats[query_id] = stats
+            if journal is not None:
+                pickle.dump((query_id, processed_qs[query_id], rec, error_msg, stats), journal)
+                journal.flush()
     except:
         for future in futures:
             if not future.done():
                 future.cancel()
+    finally:
+        if journal is not None:
+            journal.close()
             
     recs = []
     error_msgs = []
@@ -122,10 +445,27 @@ def compute_records(processed_qs: List[str]):
             
     return recs, error_msgs
 
-def compute_record(query_id, query):
-    conn = sqlite3.connect(DB_PATH)
+def compute_record(query_id, query, db_path=DB_PATH, budget_secs=None):
+    '''
+    Execute one query and return its records, error message and execution statistics:
+    wall time in seconds, rows returned and SQLite VM steps (vm_steps_approx, rounded
+    down to a multiple of PROGRESS_STEPS). Queries slower than SLOW_QUERY_SECS also get their EXPLAIN QUERY PLAN.
+    If budget_secs is given, the query is interrupted once it runs longer than that, and its
+    stats are marked 'interrupted' so callers can tell it apart from a genuine SQL error.
+    '''
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    progress = [0]
+    interrupted = [False]
 
+    def count_steps():
+        progress[0] += 1
+        # A non-zero return value makes SQLite interrupt the query
+        interrupted[0] = budget_secs is not None and time.perf_counter() - start > budget_secs
+        return interrupted[0]
+
+    conn.set_progress_handler(count_steps, PROGRESS_STEPS)
     try:
         cursor.execute(query)
         rec = cursor.fetchall()
@@ -133,9 +473,35 @@ def compute_record(query_id, query):
     except Exception as e:
         rec = []
         error_msg = f"{type(e).__name__}: {e}"
+    conn.set_progress_handler(None, 0)
+
+    stats = {
+        'seconds': time.perf_counter() - start,
+        'rows': len(rec),
+        'vm_steps_approx': progress[0] * PROGRESS_STEPS,
+    }
+    if interrupted[0]:
+        stats['interrupted'] = True
+    if stats['seconds'] > SLOW_QUERY_SECS and not error_msg:
+        stats['plan'] = explain_query_plan(cursor, query)
 
     conn.close()
-    return query_id, rec, error_msg
+    return query_id, rec, error_msg, stats
+
+def explain_query_plan(cursor, query):
+    '''
+    Return the EXPLAIN QUERY PLAN steps of a query, indented by their depth in the plan tree.
+    '''
+    try:
+        rows = cursor.execute(f'EXPLAIN QUERY PLAN {query}').fetchall()
+    except Exception as e:
+        return [f"{type(e).__name__}: {e}"]
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append('  ' * depth[node_id] + detail)
+    return plan
 
 def compute_sql_exact_match(gt_qs: List[str], model_qs: List[str]):
     '''
@@ -166,6 +532,14 @@ def compute_record_F1(gt_records: List[Any], model_records: List[Any]):
     Helper function to compute F1 between records
     generated by ground-truth and model SQL queries
     '''
+    import numpy as np
+
+    return np.mean(compute_record_F1s(gt_records, model_records))
+
+def compute_record_F1s(gt_records: List[Any], model_records: List[Any]):
+    '''
+    Per-query record F1 scores, as averaged by compute_record_F1
+    '''
     F1s = []
     for gt_rec, model_rec in zip(gt_records, model_records):
         gt_set = set(gt_rec)
@@ -186,12 +560,15 @@ def compute_record_F1(gt_records: List[Any], model_records: List[Any]):
         F1 = 2 * precision * recall / (precision + recall + 1e-8)
         F1s.append(F1)
 
-    return np.mean(F1s)
+    return F1s
 
 def set_random_seeds(seed_value=42):
     '''
     Set random seeds for better reproducibility
     '''
+    import numpy as np
+    import torch
+
     random.seed(seed_value)
     np.random.seed(seed_value)
     